@@ -3,11 +3,10 @@
 # Description: YLS Recidivism Prediction Tool (English / ID Only Version)
 # ==============================================================================
 
+import math
 import streamlit as st
-import pandas as pd
+import numpy as np
 import xgboost as xgb
-import shap
-import matplotlib.pyplot as plt
 
 # ------------------------------------------------------------------------------
 # 1. App Configuration
@@ -93,34 +92,123 @@ for items in YLS_DOMAINS.values():
         ALL_FEATURES.append(item["id"])
         LABELS_DICT[item["id"]] = item["label"]
 
+N_FEATURES = len(ALL_FEATURES)
+# Column position of each feature in the model input row
+FEATURE_INDEX = {fid: i for i, fid in enumerate(ALL_FEATURES)}
+# Graph labels in model column order (e.g., "YLS 1a")
+FEATURE_LABELS = [LABELS_DICT.get(f, f) for f in ALL_FEATURES]
+
+# Domain header HTML (blue left border), built once
+DOMAIN_HEADERS = {
+    name: f"<div style='border-left: 5px solid #007bff; padding-left: 8px; margin-top: 15px; font-weight: bold;'>{name}</div>"
+    for name in YLS_DOMAINS
+}
+
+# Static parts of the waterfall chart, reused for every input pattern
+WATERFALL_MEASURE = ["absolute"] + ["relative"] * N_FEATURES + ["total"]
+WATERFALL_STYLE = {
+    "type": "waterfall",
+    "orientation": "h",
+    "increasing": {"marker": {"color": "#ff0051"}},
+    "decreasing": {"marker": {"color": "#008bfb"}},
+    "totals": {"marker": {"color": "#7f7f7f"}},
+}
+# Graph Adjustment (Vertical layout, all 42 items)
+WATERFALL_LAYOUT = {"height": 900, "margin": {"l": 10, "r": 10, "t": 10, "b": 10}, "showlegend": False}
+
 # ------------------------------------------------------------------------------
 # 3. Load Model (.ubj support)
 # ------------------------------------------------------------------------------
+# Positive-class SHAP values of the first row, for each shap_values() output layout
+def shap_slice_per_class_list(sv):
+    # One array per class
+    return sv[1][0]
+
+def shap_slice_3d(sv):
+    # (rows, features, classes)
+    return sv[0, :, 1]
+
+def shap_slice_2d(sv):
+    # (rows, features)
+    return sv[0]
+
 @st.cache_resource
 def load_ai_model():
-    model = xgb.XGBClassifier()
     try:
-        # Load the lightweight .ubj model
-        model.load_model("yls_model.ubj")
+        # Load the lightweight .ubj model with XGBoost's native loader
+        booster = xgb.Booster(model_file="yls_model.ubj")
     except Exception as e:
-        return None, f"Model loading error: {e}"
+        return None, None, None, None, f"Model loading error: {e}"
+    # Single-row TreeSHAP (pred_contribs) gains nothing from threading; avoid spawn overhead
+    booster.set_param({"nthread": 1})
     
-    explainer = shap.TreeExplainer(model)
-    return model, explainer
+    # SHAP is only needed once the model is available; import it here so its
+    # start-up cost is paid inside the cached loader
+    import shap
+    explainer = shap.TreeExplainer(booster, feature_perturbation="tree_path_dependent")
+
+    # Detect the SHAP output layout once, so the hot path needs no try/except.
+    # The probe is the all-unchecked input, which is also the initial page state.
+    probe = explainer.shap_values(np.zeros((1, N_FEATURES), dtype=np.float32), check_additivity=False)
+    if isinstance(probe, list):
+        shap_slice = shap_slice_per_class_list
+    elif probe.ndim == 3:
+        shap_slice = shap_slice_3d
+    else:
+        shap_slice = shap_slice_2d
+    # shap_values() replaces expected_value with XGBoost's own bias term on
+    # first use, so the base value is read only after the probe
+    # (positive class last when the explainer reports one value per class)
+    base_value = float(np.ravel(explainer.expected_value)[-1])
+    return booster, explainer, shap_slice, base_value, shap_slice(probe)
 
-model, explainer = load_ai_model()
+# Reuse this session's copy if the resource cache was evicted meanwhile
+ai_model = st.session_state.get("ai_model") or load_ai_model()
+booster, explainer, shap_slice, base_value, zero_shap = ai_model
 
-if model is None:
+def mask_to_row(mask):
+    # mask: bit i is set when ALL_FEATURES[i] is checked -> (1, 42) float32 model input
+    bits = np.unpackbits(np.array([mask], dtype="<u8").view(np.uint8), bitorder="little")
+    return bits[:N_FEATURES].astype(np.float32).reshape(1, N_FEATURES)
+
+@st.cache_data(max_entries=512)
+def compute_shap(mask):
+    # shap_values() returns a bare ndarray, skipping Explanation construction.
+    # check_additivity=False avoids a second full predict over the ensemble.
+    return shap_slice(explainer.shap_values(mask_to_row(mask), check_additivity=False))
+
+@st.cache_data(max_entries=512)
+def render_waterfall(mask, _values):
+    # Returns the SHAP waterfall chart for one input pattern as a Plotly figure dict
+    # (_values is determined by mask, so it is left out of the cache hash)
+    values = _values
+    # Smallest contributions at the bottom, largest just below f(x) (same as shap.plots.waterfall)
+    order = np.argsort(np.abs(values))
+
+    # Plain figure dict: skips go.Figure construction on cache misses
+    trace = dict(
+        WATERFALL_STYLE,
+        measure=WATERFALL_MEASURE,
+        x=[base_value] + [float(values[i]) for i in order] + [0],
+        # Use ID labels (e.g., "YLS 1a") for the graph
+        y=["E[f(X)]"] + [f"{(mask >> i) & 1} = {FEATURE_LABELS[i]}" for i in order] + ["f(x)"],
+    )
+    return {"data": [trace], "layout": WATERFALL_LAYOUT}
+
+if booster is None:
     st.error("⚠️ Error: 'yls_model.ubj' not found. Please ensure the model file is in the directory.")
     st.stop()
 
+st.session_state["ai_model"] = ai_model
+
 # ------------------------------------------------------------------------------
 # 4. Layout (Left 35% : Right 65%)
 # ------------------------------------------------------------------------------
 col_input, col_result = st.columns([0.35, 0.65])
 
 # --- Left Panel: Input Checkboxes ---
-user_inputs = {}
+# All 42 answers packed into one int: bit i is set when ALL_FEATURES[i] is checked
+mask = 0
 
 with col_input:
     st.markdown("### 📋 Input Items")
@@ -128,27 +216,24 @@ with col_input:
     # Display by Domain
     for domain_name, items in YLS_DOMAINS.items():
         # Display domain header with a blue left border
-        st.markdown(
-            f"<div style='border-left: 5px solid #007bff; padding-left: 8px; margin-top: 15px; font-weight: bold;'>{domain_name}</div>",
-            unsafe_allow_html=True
-        )
+        st.markdown(DOMAIN_HEADERS[domain_name], unsafe_allow_html=True)
         
         for item in items:
             # Checkbox
             is_checked = st.checkbox(item["label"], key=item["id"])
-            user_inputs[item["id"]] = 1 if is_checked else 0
+            mask |= int(is_checked) << FEATURE_INDEX[item["id"]]
 
 # --- Right Panel: Results ---
 with col_result:
     st.markdown("### 📊 Prediction Result")
 
-    # Create Input DataFrame
-    input_df = pd.DataFrame([user_inputs])
-    valid_input_df = input_df[ALL_FEATURES]
-
-    # Prediction
-    prob = model.predict_proba(valid_input_df)[0][1]
-    total_score = valid_input_df.sum(axis=1).values[0]
+    # Prediction: SHAP values add up to the model's log-odds output, so the
+    # probability comes from the same (cached) tree walk as the graph
+    total_score = mask.bit_count()
+    # Nothing checked: reuse the SHAP values computed at model load
+    shap_values = zero_shap if mask == 0 else compute_shap(mask)
+    logit = base_value + float(shap_values.sum())
+    prob = 1.0 / (1.0 + math.exp(-logit))
 
     # Risk Level Logic (Based on Excel sheet thresholds)
     if prob >= 0.71:
@@ -185,7 +270,7 @@ with col_result:
             {prob * 100:.1f}%
         </div>
         <p style="font-size: 14px; color: #333; margin-top: 5px;">
-            Total Score: <b>{int(total_score)}</b> / 42
+            Total Score: <b>{total_score}</b> / {N_FEATURES}
         </p>
     </div>
     """, unsafe_allow_html=True)
@@ -193,17 +278,6 @@ with col_result:
     # SHAP Graph Display
     st.markdown("**【Factor Analysis (SHAP Waterfall Plot)】**")
     
-    shap_values = explainer(valid_input_df)
-    # Use ID labels (e.g., "YLS 1a") for the graph
-    shap_values.feature_names = [LABELS_DICT.get(f, f) for f in ALL_FEATURES]
-
-    # Graph Adjustment (Vertical layout)
-    fig, ax = plt.subplots(figsize=(8, 12))
-    
-    try:
-        # Display all 42 items
-        shap.plots.waterfall(shap_values[0, :, 1], max_display=42, show=False)
-    except:
-        shap.plots.waterfall(shap_values[0], max_display=42, show=False)
-    
-    st.pyplot(fig)
+    # Cached per input pattern, so revisiting a previous state skips
+    # both TreeSHAP and building the chart
+    st.plotly_chart(render_waterfall(mask, shap_values), width="stretch")